@@ -1,19 +1,34 @@
 import argparse
-import copy
-import glob
+import ast
+import concurrent.futures
+import contextlib
+import functools
 import json
+import mmap
+import operator
 import os
 import re
+import struct
 import sys
 
-import elftools.construct.macros as macros  # noqa: I900
 import elftools.elf.elffile as elffile  # noqa: I900
-import elftools.elf.structs as structs  # noqa: I900
-from jsonmerge import merge
+from elftools.elf.sections import SymbolTableSection  # noqa: I900
 
-symbols = {}
+from pysymbolcheck import _fast_elf
+
+# Symbol tables, one dict per attribute keyed by symbol name
+_sizes = {}
+_types = {}
+_files = {}
+_used_in = {}
+# Names a definition was merged for
+_defined = set()
 rules = {}
 fut = None
+_largest_cache = None
+_EMPTY = frozenset()
+_dir_index = {}
+_dir_listing = {}
 
 _mapping_table = {
     r"AVAILABLE\(([A-Za-z0-9_]*)\)": r"__get_available('\1')",
@@ -26,119 +41,238 @@ _mapping_table = {
     r"\!": r" not ",
 }
 
+_compiled_mapping = [(re.compile(k), v) for k, v in _mapping_table.items()]
+_ws_re = re.compile(r"\s{2,}")
+
+_compiled_rules = {}
+
+_binary_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+
+_unary_operators = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+}
+
+_compare_operators = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
 
 def __get_largest_symbol():
-    global symbols
-    return max([symbols[k]["size"] for k in symbols.keys()])
+    global _largest_cache
+    if _largest_cache is None:
+        _largest_cache = max(_sizes.values())
+    return _largest_cache
 
 
 def __get_available(item):
-    global symbols
-    return item in symbols.keys()
+    return item in _sizes
 
 
 def __get_used(item):
-    global symbols
     global fut
-    if item not in symbols.keys():
-        return False
-    return symbols[item]["file"] == fut or ("used_in" in symbols[item] and fut in symbols[item]["used_in"])
+    return _files.get(item) == fut or fut in _used_in.get(item, _EMPTY)
 
 
 def __get_size(item):
-    global symbols
-    if item not in symbols or "size" not in symbols[item]:
-        return ""
-    if isinstance(symbols[item]["size"], str):
-        return int(symbols[item]["size"])
-    return symbols[item]["size"]
+    return _sizes.get(item, "")
 
 
 def __get_type(item, type_):
-    global symbols
-    if item not in symbols or "type" not in symbols[item]:
-        return ""
-    return symbols[item]["type"]
+    return _types.get(item, "")
 
 
-def find_lib_in_path(filename, lib_path):
+_rule_functions = {
+    "__get_available": __get_available,
+    "__get_used": __get_used,
+    "__get_size": __get_size,
+    "__get_type": __get_type,
+    "__get_largest_symbol": __get_largest_symbol,
+}
+
+
+def get_dir_listing(lib):
+    if lib not in _dir_listing:
+        try:
+            with os.scandir(lib) as it:
+                _dir_listing[lib] = frozenset(x.name for x in it)
+        except OSError:
+            _dir_listing[lib] = _EMPTY
+    return _dir_listing[lib]
+
+
+def get_dir_index(lib):
+    if lib not in _dir_index:
+        index = {}
+        visited = set()
+        # Follow symlinked dirs like glob did, but walk each real directory only once
+        for root, dirs, files in os.walk(lib, followlinks=True):
+            real = os.path.realpath(root)
+            if real in visited:
+                dirs[:] = []
+                continue
+            visited.add(real)
+            for name in files:
+                index.setdefault(name, os.path.join(root, name))
+        _dir_index[lib] = index
+    return _dir_index[lib]
+
+
+@functools.lru_cache(maxsize=None)
+def _find_lib_in_path(filename, lib_path):
     if os.path.isabs(filename):
         return filename
     for lib in lib_path:
-        # Check for in root first
-        if os.path.exists(lib + "/" + filename):
-            return lib + "/" + filename
+        # Check for in root first, stat only if the directory listing has a match
+        path = lib + "/" + filename
+        if (os.sep in filename or filename in get_dir_listing(lib)) and os.path.exists(path):
+            return path
     for lib in lib_path:
         # lookup in subdirs
-        if any(glob.glob(lib + "/**/" + filename, recursive=True)):
-            return glob.glob(lib + "/**/" + filename, recursive=True)[0]
-    sys.stderr.write("Can't find the needed lib {fn}\n".format(fn=filename))
+        if path := get_dir_index(lib).get(filename):
+            return path
+    sys.stderr.write(f"Can't find the needed lib {filename}\n")
     sys.exit(-1)
 
 
+def find_lib_in_path(filename, lib_path):
+    return _find_lib_in_path(filename, tuple(lib_path))
+
+
 def get_soname(filename, lib_path):
-    stream = open(find_lib_in_path(filename, lib_path), 'rb')
-    f = None
+    return _get_soname(find_lib_in_path(filename, lib_path))
+
+
+def _elf_error():
+    sys.stderr.write("Can't read input file - Seems not to be an elf\n")
+    sys.exit(-1)
+
+
+@contextlib.contextmanager
+def _map_file(path):
+    with open(path, 'rb') as fh:
+        if not os.fstat(fh.fileno()).st_size:
+            _elf_error()
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def _load_elf(mm):
     try:
-        f = elffile.ELFFile(stream)
+        return elffile.ELFFile(mm)
     except Exception:
-        sys.stderr.write("Can't read input file - Seems not to be an elf\n")
-        sys.exit(-1)
+        _elf_error()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_soname(path):
+    with _map_file(path) as mm:
+        try:
+            return _fast_elf.get_soname(mm)
+        except ValueError:
+            return _get_soname_elftools(_load_elf(mm))
+
+
+def _get_soname_elftools(f):
     dynamic = f.get_section_by_name('.dynamic')
     dynstr = f.get_section_by_name('.dynstr')
 
     # Handle libraries built for different machine architectures:
     if f.header['e_machine'] == 'EM_X86_64':
-        st = structs.Struct('Elf64_Dyn',
-                            macros.ULInt64('d_tag'),
-                            macros.ULInt64('d_val'))
+        fmt = '<QQ'
     elif f.header['e_machine'] == 'EM_386':
-        st = structs.Struct('Elf32_Dyn',
-                            macros.ULInt32('d_tag'),
-                            macros.ULInt32('d_val'))
+        fmt = '<II'
     else:
         raise RuntimeError('unsupported machine architecture')
     results = []
     try:
-        entsize = dynamic['sh_entsize']
-        for k in range(int(dynamic['sh_size'] / entsize)):
-            result = st.parse(dynamic.data()[k * entsize:(k + 1) * entsize])
-            if result.d_tag == 1:
-                results.append(dynstr.get_string(result.d_val))
+        data = dynamic.data()
+        for d_tag, d_val in struct.iter_unpack(fmt, data[:len(data) - len(data) % struct.calcsize(fmt)]):
+            if d_tag == 1:
+                results.append(dynstr.get_string(d_val))
     except (KeyError, TypeError, AttributeError):
         pass
     return results
 
 
 def get_symbols(filename, lib_path):
+    return _get_symbols(find_lib_in_path(filename, lib_path), filename)
+
+
+def _get_symbols(path, filename):
+    with _map_file(path) as mm:
+        try:
+            return _fast_elf.get_symbols(mm, filename)
+        except ValueError:
+            return _get_symbols_elftools(_load_elf(mm), filename)
+
+
+def _get_symbols_elftools(f, filename):
     result = {}
-    stream = open(find_lib_in_path(filename, lib_path), 'rb')
-    f = None
-    try:
-        f = elffile.ELFFile(stream)
-    except Exception:
-        sys.stderr.write("Can't read input file - Seems not to be an elf\n")
-        sys.exit(-1)
+    filename = sys.intern(filename)
     for sec in f.iter_sections():
-        try:
-            for sym in sec.iter_symbols():
-                if not sym.name:
-                    continue
-                entry = {"size": sym.entry.st_size or 0,
-                         "type": sym.entry.st_info.type, "file": filename, "section": sec.name}
-                if sym.entry.st_shndx == 'SHN_UNDEF':
-                    entry["used_in"] = [filename]
-                result[sym.name] = entry
-        except Exception:  # noqa: S110
-            pass
+        if not isinstance(sec, SymbolTableSection):
+            continue
+        section = sys.intern(sec.name)
+        for sym in sec.iter_symbols():
+            if not sym.name:
+                continue
+            entry = {"size": int(sym.entry.st_size or 0),
+                     "type": sym.entry.st_info.type, "file": filename, "section": section}
+            if sym.entry.st_shndx == 'SHN_UNDEF':
+                entry["used_in"] = frozenset((filename,))
+            result[sys.intern(sym.name)] = entry
     return result
 
 
+def merge_symbols(entries):
+    for name, entry in entries.items():
+        if "used_in" in entry:
+            _used_in[name] = _used_in.get(name, _EMPTY) | entry["used_in"]
+            # A reference only adds its user, it doesn't override a definition
+            if name in _files:
+                continue
+        elif name in _defined:
+            # Like the dynamic linker, the first definition in breadth first order wins
+            continue
+        else:
+            _defined.add(name)
+        _sizes[name] = entry["size"]
+        _types[name] = entry["type"]
+        _files[name] = entry["file"]
+
+
 def get_symbols_rec(filename, lib_path):
-    res = get_symbols(filename, lib_path)
-    for lib in get_soname(filename, lib_path):
-        res = merge(res, get_symbols_rec(lib, lib_path))
-    return res
+    for table in (_sizes, _types, _files, _used_in, _defined):
+        table.clear()
+    # resolved path -> name it was referenced by, in breadth first order
+    closure = {}
+    pending = [filename]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        while pending:
+            level = {}
+            for lib in pending:
+                path = find_lib_in_path(lib, lib_path)
+                if path not in closure:
+                    level.setdefault(path, lib)
+            closure.update(level)
+            pending = [lib for libs in ex.map(_get_soname, level) for lib in libs]
+        for entries in ex.map(_get_symbols, closure, closure.values()):
+            merge_symbols(entries)
 
 
 def report_issues(rule):
@@ -146,27 +280,152 @@ def report_issues(rule):
     sys.stdout.write(f'{fut}:{rule["severity"]}:{rule["id"]}: {rule["msg"]}\n')  # noqa: E231
 
 
+def _compile_and(values):
+    def _eval():
+        res = True
+        for value in values:
+            res = value()
+            if not res:
+                return res
+        return res
+    return _eval
+
+
+def _compile_or(values):
+    def _eval():
+        res = False
+        for value in values:
+            res = value()
+            if res:
+                return res
+        return res
+    return _eval
+
+
+def _compile_compare(left, ops, comparators):
+    def _eval():
+        lhs = left()
+        for op, comparator in zip(ops, comparators):
+            rhs = comparator()
+            if not op(lhs, rhs):
+                return False
+            lhs = rhs
+        return True
+    return _eval
+
+
+def _unsupported(node):
+    raise SyntaxError(f"unsupported expression {type(node).__name__} at offset {getattr(node, 'col_offset', 0)}")
+
+
+def _build_expression(node):
+    return _compile_node(node.body)
+
+
+def _build_boolop(node):
+    values = [_compile_node(x) for x in node.values]
+    if isinstance(node.op, ast.And):
+        return _compile_and(values)
+    return _compile_or(values)
+
+
+def _build_unaryop(node):
+    if type(node.op) not in _unary_operators:
+        _unsupported(node)
+    op = _unary_operators[type(node.op)]
+    operand = _compile_node(node.operand)
+    return lambda: op(operand())
+
+
+def _build_binop(node):
+    if type(node.op) not in _binary_operators:
+        _unsupported(node)
+    op = _binary_operators[type(node.op)]
+    left = _compile_node(node.left)
+    right = _compile_node(node.right)
+    return lambda: op(left(), right())
+
+
+def _build_compare(node):
+    if not all(type(x) in _compare_operators for x in node.ops):
+        _unsupported(node)
+    return _compile_compare(_compile_node(node.left),
+                            [_compare_operators[type(x)] for x in node.ops],
+                            [_compile_node(x) for x in node.comparators])
+
+
+def _is_rule_call(node):
+    return (isinstance(node.func, ast.Name) and node.func.id in _rule_functions and
+            not node.keywords and all(isinstance(x, ast.Constant) for x in node.args))
+
+
+def _build_call(node):
+    if not _is_rule_call(node):
+        _unsupported(node)
+    func = _rule_functions[node.func.id]
+    args = tuple(x.value for x in node.args)
+    return lambda: func(*args)
+
+
+def _build_constant(node):
+    value = node.value
+    return lambda: value
+
+
+def _build_tuple(node):
+    if not all(isinstance(x, ast.Constant) for x in node.elts):
+        _unsupported(node)
+    value = tuple(x.value for x in node.elts)
+    return lambda: value
+
+
+_node_builders = {
+    ast.Expression: _build_expression,
+    ast.BoolOp: _build_boolop,
+    ast.UnaryOp: _build_unaryop,
+    ast.BinOp: _build_binop,
+    ast.Compare: _build_compare,
+    ast.Call: _build_call,
+    ast.Constant: _build_constant,
+    ast.Tuple: _build_tuple,
+}
+
+
+def _compile_node(node):
+    if type(node) not in _node_builders:
+        _unsupported(node)
+    return _node_builders[type(node)](node)
+
+
+def _compile_rule(rule):
+    if rule not in _compiled_rules:
+        org_rule = rule
+        for pattern, repl in _compiled_mapping:
+            org_rule = pattern.sub(repl, org_rule)
+        # Any whitespace besides a plain space is non printable, so this only skips rules _ws_re wouldn't change
+        if "  " in org_rule or not org_rule.isprintable():
+            org_rule = _ws_re.sub(" ", org_rule)
+        org_rule = org_rule.strip()
+        _compiled_rules[rule] = _compile_node(ast.parse(org_rule, "rule", "eval"))
+    return _compiled_rules[rule]
+
+
 def parse_rules(item):
-    global _mapping_table
-    global fut
-    org_rule = copy.deepcopy(item["rule"])
-    for k, v in _mapping_table.items():
-        org_rule = re.sub(k, v, org_rule)
-    org_rule = re.sub(r"\s{2,}", " ", org_rule).strip()
     try:
-        compile(org_rule, "pattern_test", "eval")  # noqa: DUO110
-        if eval(org_rule):  # noqa: DUO104, S307
+        if _compile_rule(item["rule"])():
             report_issues(item)
             return False
     except Exception as e:
-        sys.stderr.write(
-            "Rule {rule} is not well-formed: {e}\n".format(rule=item["rule"], e=e))
+        sys.stderr.write(f'Rule {item["rule"]} is not well-formed: {e}\n')
         return False
     return True
 
 
 def eval_rules(rules):
-    return all(parse_rules(x) for x in rules)
+    failed = False
+    for x in rules:
+        failed |= not parse_rules(x)
+    return not failed
 
 
 def create_argparses():
@@ -189,10 +448,10 @@ def get_std_lib_paths():
 
 
 def main():
-    global symbols
+    global _largest_cache
     global fut
     args = create_argparses().parse_args()
-    args.libpath = [os.getcwd()] + args.libpath.split(":") + get_std_lib_paths()
+    args.libpath = [os.getcwd()] + [x for x in args.libpath.split(":") if x] + get_std_lib_paths()
     fut = args.file
     if not os.path.isfile(fut):
         sys.stderr.write("File is not a file\n")
@@ -204,7 +463,8 @@ def main():
         sys.stderr.write("Can't parse rules\n")
         sys.exit(-1)
 
-    symbols = get_symbols_rec(args.file, args.libpath)
+    get_symbols_rec(args.file, args.libpath)
+    _largest_cache = None
     if not eval_rules(rules):
         sys.exit(1)
     sys.exit(0)
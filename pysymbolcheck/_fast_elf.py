@@ -0,0 +1,128 @@
+import collections
+import struct
+import sys
+
+# Minimal ELF reader for the bits pysymbolcheck needs (DT_NEEDED and symbol tables).
+# Anything it can't handle raises ValueError, so callers can fall back to pyelftools.
+
+SHT_SYMTAB = 2
+SHT_DYNAMIC = 6
+SHT_DYNSYM = 11
+SHT_SUNW_LDYNSYM = 0x6ffffff3
+SHN_UNDEF = 0
+SHN_XINDEX = 0xffff
+DT_NEEDED = 1
+
+# Same names as elftools.elf.enums.ENUM_ST_INFO_TYPE, unknown types are passed as int
+_st_info_types = {
+    0: 'STT_NOTYPE',
+    1: 'STT_OBJECT',
+    2: 'STT_FUNC',
+    3: 'STT_SECTION',
+    4: 'STT_FILE',
+    5: 'STT_COMMON',
+    6: 'STT_TLS',
+    7: 'STT_NUM',
+    8: 'STT_RELC',
+    9: 'STT_SRELC',
+    10: 'STT_LOOS',
+    12: 'STT_HIOS',
+    13: 'STT_LOPROC',
+    15: 'STT_HIPROC',
+}
+
+Section = collections.namedtuple('Section', ['name', 'type', 'offset', 'size', 'link', 'entsize'])
+
+
+class ELFFile():
+    def __init__(self, data):
+        if data[:4] != b'\x7fELF':
+            raise ValueError('not an elf file')
+        if data[4] not in (1, 2) or data[5] not in (1, 2):
+            raise ValueError('unsupported elf class or data encoding')
+        self.data = data
+        self.is64 = data[4] == 2
+        self.endian = '<' if data[5] == 1 else '>'
+        self.sections = self.__read_sections()
+
+    def __read_sections(self):
+        if self.is64:
+            ehdr, shdr = 'HHIQQQIHHHHHH', 'IIQQQQIIQQ'
+        else:
+            ehdr, shdr = 'HHIIIIIHHHHHH', 'IIIIIIIIII'
+        ehdr = struct.unpack_from(self.endian + ehdr, self.data, 16)
+        e_shoff, e_shentsize, e_shnum, e_shstrndx = ehdr[5], ehdr[10], ehdr[11], ehdr[12]
+        if not e_shoff:
+            return []
+
+        def header(index):
+            return struct.unpack_from(self.endian + shdr, self.data, e_shoff + index * e_shentsize)
+
+        first = header(0)
+        # Extended numbering, the real values are stored in the first section header
+        if not e_shnum:
+            e_shnum = first[5]
+        if e_shstrndx == SHN_XINDEX:
+            e_shstrndx = first[6]
+        headers = [first] + [header(x) for x in range(1, e_shnum)]
+        shstrtab_offset = headers[e_shstrndx][4]
+        return [Section(self.__get_string(shstrtab_offset + h[0]), h[1], h[4], h[5], h[6], h[9]) for h in headers]
+
+    def __get_string(self, offset):
+        end = self.data.find(b'\x00', offset)
+        if end < 0:
+            raise ValueError('unterminated string')
+        return self.data[offset:end].decode('utf-8', errors='replace')
+
+    def __iter_entries(self, sec, fmt):
+        fmt = self.endian + fmt
+        count = min(sec.size, len(self.data) - sec.offset) // struct.calcsize(fmt)
+        return struct.iter_unpack(fmt, self.data[sec.offset:sec.offset + count * struct.calcsize(fmt)])
+
+    def get_needed(self):
+        results = []
+        for sec in self.sections:
+            if sec.type != SHT_DYNAMIC:
+                continue
+            strtab = self.sections[sec.link]
+            for d_tag, d_val in self.__iter_entries(sec, 'QQ' if self.is64 else 'II'):
+                if d_tag == DT_NEEDED:
+                    results.append(self.__get_string(strtab.offset + d_val))
+        return results
+
+    def iter_symbols(self):
+        for sec in self.sections:
+            if sec.type not in (SHT_SYMTAB, SHT_DYNSYM, SHT_SUNW_LDYNSYM):
+                continue
+            strtab = self.sections[sec.link]
+            if self.is64:
+                entries = ((n, i, x, s) for n, i, _, x, _, s in self.__iter_entries(sec, 'IBBHQQ'))
+            else:
+                entries = ((n, i, x, s) for n, _, s, i, _, x in self.__iter_entries(sec, 'IIIBBH'))
+            for st_name, st_info, st_shndx, st_size in entries:
+                st_type = st_info & 0xf
+                yield (self.__get_string(strtab.offset + st_name) if st_name else '',
+                       st_size, _st_info_types.get(st_type, st_type), st_shndx, sec.name)
+
+
+def get_soname(data):
+    try:
+        return ELFFile(data).get_needed()
+    except (struct.error, IndexError) as e:
+        raise ValueError(e) from e
+
+
+def get_symbols(data, filename):
+    result = {}
+    filename = sys.intern(filename)
+    try:
+        for name, size, type_, shndx, section in ELFFile(data).iter_symbols():
+            if not name:
+                continue
+            entry = {"size": int(size), "type": type_, "file": filename, "section": sys.intern(section)}
+            if shndx == SHN_UNDEF:
+                entry["used_in"] = frozenset((filename,))
+            result[sys.intern(name)] = entry
+    except (struct.error, IndexError) as e:
+        raise ValueError(e) from e
+    return result
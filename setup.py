@@ -40,5 +40,5 @@ setuptools.setup(
         "Programming Language :: Python :: 3",
         "Topic :: Software Development :: Quality Assurance",
     ],
-    python_requires='>=3.7',
+    python_requires='>=3.9',
 )